@@ -7,6 +7,8 @@ Created on 17/Jan/2020
 
 import numpy as np
 import random
+import itertools
+import tracemalloc
 # to deal with image manipulation
 import skimage
 from skimage.color import rgb2gray
@@ -54,6 +56,44 @@ class Mtkeras:
         self.violatingCases = []
         self.model = model
 
+    '''
+    Summary:
+        For 8-bit images (uint8 ndarray), the intensity MRIPs (additive, multiplicative, brightness and invertive) are pointwise functions of 256 input values.
+        Instead of making a full pass over the dataset, each step is applied to a 256-entry lookup table, which starts as the values 0 to 255 in uint8 and goes through exactly the same arithmetic (and dtype changes) as the dataset would. The table is applied to the dataset with a single np.take over the uint8 data the next time ".myTestSet" is read, so the result is identical to running the steps one by one.
+
+    Args:
+        - step: a function which applies the MRIP to the lookup table and returns the new table, or None if the step can not be fused
+        - dataTypes(optional): the dataTypes the MRIP supports. Default value is ('grayscaleImage', 'colorImage')
+
+    Returns:
+        True if the step has been folded into the pending table, False if the dataset is not an 8-bit image set of a supported dataType or the step can not be fused
+    '''
+
+    def fuseLut(self, step, dataTypes=('grayscaleImage', 'colorImage')):
+        if(self.dataType not in dataTypes or
+                getattr(self._myTestSet, 'dtype', None) != np.uint8):
+            return False
+        lut = self.pendingLut
+        if(lut is None):
+            lut = np.arange(256, dtype=np.uint8)
+        lut = step(lut)
+        if(lut is None):
+            return False
+        self.pendingLut = lut
+        return True
+
+    @property
+    def myTestSet(self):
+        if(self.pendingLut is not None):
+            self._myTestSet = np.take(self.pendingLut, self._myTestSet)
+            self.pendingLut = None
+        return self._myTestSet
+
+    @myTestSet.setter
+    def myTestSet(self, value):
+        self.pendingLut = None
+        self._myTestSet = value
+
     '''
     Summary:
         The "permutative" MRIP: the user can shuffle the order of the data randomly in the dataset
@@ -87,6 +127,9 @@ class Mtkeras:
     '''
 
     def additive(self, n_additive):
+        # 8-bit images: fold the step into the pending lookup table
+        if(self.fuseLut(lambda lut: lut + float(n_additive), ('grayscaleImage',))):
+            return self
         # add a constant to every pixel in a picture
         if(self.dataType == 'grayscaleImage'):
             picx = self.myTestSet.shape[1]
@@ -109,11 +152,15 @@ class Mtkeras:
     '''
 
     def brightness(self, gamma=1, gain=1):
+        # adjust_gamma refuses negative values, which only the pixels can tell
+        if(self.fuseLut(lambda lut: None if lut.min() < 0 else
+                        skimage.exposure.adjust_gamma(lut, gamma, gain).astype(lut.dtype))):
+            return self
         # adjust the brightness of the picture
         for index, ele in enumerate(self.myTestSet):
             self.myTestSet[index] = skimage.exposure.adjust_gamma(
                 ele, gamma, gain)
-            return self
+        return self
 
     '''
     Summary:
@@ -128,6 +175,8 @@ class Mtkeras:
     '''
 
     def multiplicative(self, n_mul):
+        if(self.fuseLut(lambda lut: lut * n_mul, ('grayscaleImage',))):
+            return self
         # multiple every pixel by a constant
         if(self.dataType == 'grayscaleImage'):
             self.myTestSet = self.myTestSet * n_mul
@@ -146,11 +195,17 @@ class Mtkeras:
     '''
 
     def invertive(self):
+        if(self.fuseLut(lambda lut: 255 - lut)):
+            return self
         # invert the order of the text sequence
         if(self.dataType == 'text'):
             for i in range(len(self.myTestSet)):
                 self.myTestSet[i].reverse()
             return self
+        # invert the intensity of every pixel in a picture
+        elif(self.dataType in ('grayscaleImage', 'colorImage')):
+            self.myTestSet = 255 - self.myTestSet
+            return self
 
     '''
     Summary:
@@ -199,6 +254,29 @@ class Mtkeras:
                 i = " " + i
             return self
 
+    '''
+    Summary:
+        the "synonym" MRIP: replace some of the words in a text by one of their nearest neighbors in an embedding space, which is a more realistic noise than inserting a word.
+        The neighbors are looked up in a precomputed index (see build_neighbor_index), and the substitutions are done in one batch over all the words of the dataset.
+        Padded sequences (a 2D int ndarray, e.g. the output of pad_sequences) are processed fully in numpy and are the path that generates the follow-ups of 10^6 texts in seconds. Lists of word lists have to be flattened and rebuilt in Python, which takes about 45 s for 10^6 texts of 230 words.
+
+    Args:
+        - neighbors: ndarray or string, the nearest neighbor index returned by build_neighbor_index, or the path of the .npy file it has been saved to (it is memory-mapped)
+        - rate(optional): float, the probability for each word to be replaced. Default value is 0.1
+        - reserved(optional): integer, the word indexes smaller than it (padding, start, unknown...) are never replaced. Default value is 4
+
+    Returns:
+        - a Mtkeras Object
+        - call the property ".myTestSet" to return a tranformed dataset(a list, or an ndarray if the texts are padded sequences)
+    '''
+
+    def synonym(self, neighbors, rate=0.1, reserved=4):
+        # replace random words by their neighbors in the embedding space
+        if(self.dataType == 'text'):
+            self.myTestSet = substitute_synonyms(
+                self.myTestSet, neighbors, rate, reserved)
+            return self
+
     '''
     Summary:
         the "fliph" MRIP: flip the data horizontally
@@ -293,35 +371,14 @@ class Mtkeras:
 
     def equality(self, params=None):
         if(self.dataType == 'grayscaleImage'):
-            index_one = self.myTestSet.shape[0]
-            index_two = self.myTestSet.shape[1]
-            index_three = self.myTestSet.shape[2]
-
-            self.myTestSet = self.myTestSet.reshape(
-                index_one, index_two * index_three)/255
-            self.myStartTestSet = self.myStartTestSet.reshape(
-                index_one, index_two * index_three)/255
-
-            predict1 = self.model.predict_classes(self.myTestSet)
-            predict2 = self.model.predict_classes(self.myStartTestSet)
-            for index in range(len(predict1)):
-                if(predict1[index] != predict2[index]):
-                    self.violatingCases.append(index)
+            self.myStartTestSet, self.myTestSet = self.modelInputs()
+            self.violatingCases += violating_indexes(
+                self.model, self.myStartTestSet, self.myTestSet)
 
         elif(self.dataType == 'colorImage'):
-            sourceOutput = []
-            followUpOutput = []
-            for ele in self.myTestSet:
-                followUpOutput.append(process_img(ele).tolist())
-            for ele in self.myStartTestSet:
-                sourceOutput.append(process_img(ele).tolist())
-
-            predict1 = self.model.predict_classes(np.array(sourceOutput))
-            predict2 = self.model.predict_classes(np.array(followUpOutput))
-
-            for index in range(len(predict1)):
-                if(predict1[index] != predict2[index]):
-                    self.violatingCases.append(index)
+            sourceInput, followUpInput = self.modelInputs()
+            self.violatingCases += violating_indexes(
+                self.model, sourceInput, followUpInput)
 
         elif(self.dataType == 'searchTerm'):
             sourceOutput = test_search_engine(self.myStartTestSet, **params)
@@ -337,6 +394,391 @@ class Mtkeras:
             num=len(self.violatingCases)))
         return self
 
+    '''
+    Summary:
+        the "differential" MROP: run the "equal" MROP with several versions of a model on the same follow-up test cases, e.g. the model before and after retraining. The follow-up test cases are generated and preprocessed only once for all the models.
+        Only the cases whose verdict is not the same for all the models are reported.
+
+    Args:
+        - models(optional): a list of at least two models undertest, the default value is the "model" argument of Mtkeras, which has to be such a list then
+
+    Returns:
+        - a Mtkeras Object
+        - call the property ".changedCases" to return the indexes of the cases whose verdict changed between the models
+        - call the property ".changedVerdicts" to return, for every changed case, a list of booleans telling whether it violates the MR for each model
+        - call the property ".modelViolations" to return the number of violation cases of each model
+
+    Outputs:
+        the number of the violation cases of each model and the number of the changed cases will be printed
+    '''
+
+    def differential(self, models=None):
+        if(models is None):
+            models = self.model
+        if(not isinstance(models, (list, tuple)) or len(models) < 2):
+            raise ValueError(
+                "MROP differential needs a list of at least two models.")
+        if(self.dataType not in ('grayscaleImage', 'colorImage')):
+            raise ValueError(
+                "MROP differential does not support the dataType {}.".format(self.dataType))
+        if(len(self.myStartTestSet) == 0):
+            self.modelViolations = [0] * len(models)
+            self.changedCases = []
+            self.changedVerdicts = []
+            print("There are 0 cases whose verdict changed between the models.")
+            return self
+        sourceInput, followUpInput = self.modelInputs()
+        verdicts = np.zeros((len(models), len(sourceInput)), dtype=bool)
+        for i, model in enumerate(models):
+            verdicts[i, violating_indexes(model, sourceInput, followUpInput)] = True
+        self.modelViolations = verdicts.sum(axis=1).tolist()
+        changed = np.any(verdicts != verdicts[0], axis=0)
+        self.changedCases = np.flatnonzero(changed).tolist()
+        self.changedVerdicts = verdicts[:, changed].T.tolist()
+        for i, count in enumerate(self.modelViolations):
+            print("There are {num} violations of MROP equality for model {i}.".format(
+                num=count, i=i))
+        print("There are {num} cases whose verdict changed between the models.".format(
+            num=len(self.changedCases)))
+        return self
+
+    '''
+    Summary:
+        the prioritized "equal" MROP: violations cluster in the source test cases the model is not confident about. A cheap first pass predicts the source test cases and ranks them by their prediction margin (the difference between the two highest probabilities) or by their entropy.
+        The follow-up test cases are then generated and tested in chunks, the least confident source test cases first, until the inference budget is used up.
+        The MRIPs are given as a chain instead of being called before, because the follow-up test cases are only generated for the source test cases that are tested.
+
+    Args:
+        - chain: a list of (name, args, kwargs) tuples, the MRIPs to be called on Mtkeras, e.g. [('fliph', (), {}), ('noise', (10,), {})]
+        - budget(optional): integer, the maximum number of inferences, the first pass over the source test set is counted in it, so it can not be smaller than the size of the source test set. The default value is twice the size of the source test set, which tests every source test case
+        - by(optional): string, "margin" or "entropy". Default value is "margin"
+        - chunkSize(optional): integer, the number of follow-up test cases generated and tested at a time. Default value is 256
+
+    Returns:
+        - a Mtkeras Object
+        - call the property ".violatingCases" to return the indexes of the violating cases, in the order they were found
+        - call the property ".testedCases" to return the indexes of the tested source test cases, in the order they were tested
+        - call the property ".violationCurve" to return a list of (inferences, violations) after every chunk, the first pass is counted in the inferences
+
+    Outputs:
+        the number of the violation cases and the number of violations per inference will be printed
+    '''
+
+    def prioritized(self, chain, budget=None, by='margin', chunkSize=256):
+        if(self.dataType not in ('grayscaleImage', 'colorImage')):
+            raise ValueError(
+                "prioritized MROP does not support the dataType {}.".format(self.dataType))
+        self.testedCases = []
+        self.violationCurve = []
+        if(len(self.myStartTestSet) == 0):
+            print("There are 0 violations of MROP equality in 0 prioritized cases.")
+            return self
+        if(budget is not None and budget < len(self.myStartTestSet)):
+            raise ValueError("The budget {} is smaller than the {} inferences of the first pass.".format(
+                budget, len(self.myStartTestSet)))
+        probabilities = self.model.predict(model_input(self.myStartTestSet, self.dataType))
+        sourceClasses = predicted_classes(probabilities)
+        order = np.argsort(confidence(probabilities, by), kind='stable')
+        if(budget is not None):
+            order = order[:budget - len(probabilities)]
+
+        inferences = len(probabilities)
+        for start in range(0, len(order), chunkSize):
+            chunk = order[start:start + chunkSize]
+            followUpClasses = predicted_classes(self.model.predict(model_input(
+                apply_chain(self.myStartTestSet[chunk], self.dataType, chain), self.dataType)))
+            for index in np.flatnonzero(followUpClasses != sourceClasses[chunk]):
+                self.violatingCases.append(int(chunk[index]))
+            self.testedCases += chunk.tolist()
+            inferences += len(chunk)
+            self.violationCurve.append((inferences, len(self.violatingCases)))
+
+        print("There are {num} violations of MROP equality in {n} prioritized cases, {rate:.4f} violations per inference.".format(
+            num=len(self.violatingCases), n=len(self.testedCases), rate=len(self.violatingCases) / inferences))
+        return self
+
+    '''
+    Summary:
+        the "equal" MROP run chunk by chunk under a memory budget. MRIPs like noise and multiplicative, and the preprocessing before prediction, make several float64 copies of the dataset, so testing the whole dataset at once may run out of memory.
+        The bytes needed per test case are first measured by running the MRIPs and the preprocessing on a few test cases, and the chunk size is chosen to stay within the budget. The actual peak of each chunk is monitored, and the chunk size is shrunk if the estimate turns out to be too low.
+        The peaks are measured with tracemalloc around the MRIPs and the preprocessing only, the model runs outside of it so the backend is not slowed down, and the memory allocated inside the model backend is not counted.
+        A warning is printed when a single test case needs more than the budget, the chunks can not be smaller than one test case.
+        If tracemalloc is already running, its peak is reset for every chunk.
+
+    Args:
+        - chain: a list of (name, args, kwargs) tuples, the MRIPs to be called on Mtkeras, e.g. [('noise', (10,), {}), ('multiplicative', (2,), {})]
+        - memoryBudget: integer, the number of bytes a chunk may use on top of the source test set
+        - probeSize(optional): integer, the number of test cases used to estimate the bytes per test case. Default value is 8
+
+    Returns:
+        - a Mtkeras Object
+        - call the property ".violatingCases" to return the indexes of the violating cases
+        - call the property ".chunkSizes" to return the size of every chunk
+        - call the property ".peakBytes" to return the measured peak of every chunk
+
+    Outputs:
+        the number of the violation cases and the number of chunks will be printed
+    '''
+
+    def budgeted(self, chain, memoryBudget, probeSize=8):
+        if(self.dataType not in ('grayscaleImage', 'colorImage')):
+            raise ValueError(
+                "budgeted MROP does not support the dataType {}.".format(self.dataType))
+        self.chunkSizes = []
+        self.peakBytes = []
+        if(len(self.myStartTestSet) == 0):
+            print("There are 0 violations of MROP equality in 0 chunks.")
+            return self
+        bytesPerSample = estimate_bytes_per_sample(
+            self.myStartTestSet[:probeSize], self.dataType, chain)
+        chunkSize = max(1, int(memoryBudget // max(bytesPerSample, 1)))
+        warned = False
+        if(bytesPerSample > memoryBudget):
+            print("Warning: one test case needs about {need:.0f} bytes, more than the memory budget of {budget} bytes.".format(
+                need=bytesPerSample, budget=memoryBudget))
+            warned = True
+        start = 0
+        while start < len(self.myStartTestSet):
+            stop = min(start + chunkSize, len(self.myStartTestSet))
+            # only the MRIPs and the preprocessing are traced, not the model
+            (sourceInput, followUpInput), peak = traced_peak(
+                self.chunkInputs, chain, start, stop)
+            self.violatingCases += [start + index for index in violating_indexes(
+                self.model, sourceInput, followUpInput)]
+            del sourceInput, followUpInput
+            self.chunkSizes.append(stop - start)
+            self.peakBytes.append(peak)
+            if(peak > memoryBudget):
+                # the estimate was too low, shrink the next chunks
+                bytesPerSample = peak / (stop - start)
+                chunkSize = max(1, int(0.9 * memoryBudget // bytesPerSample))
+                if(stop - start == 1 and not warned):
+                    print("Warning: one test case needs {need} bytes, the memory budget of {budget} bytes can not be met.".format(
+                        need=peak, budget=memoryBudget))
+                    warned = True
+            start = stop
+
+        print("There are {num} violations of MROP equality in {n} chunks.".format(
+            num=len(self.violatingCases), n=len(self.chunkSizes)))
+        return self
+
+    '''
+    Summary:
+        generate the follow-up test cases of the source test cases from "start" to "stop", and preprocess the source and follow-up test cases into the inputs of the model
+
+    Returns:
+        the source inputs and the follow-up inputs of the model
+    '''
+
+    def chunkInputs(self, chain, start, stop):
+        source = np.array(self.myStartTestSet[start:stop])
+        followUp = apply_chain(source.copy(), self.dataType, chain)
+        return model_input(source, self.dataType), model_input(followUp, self.dataType)
+
+    '''
+    Summary:
+        preprocess the source and the follow-up test cases into the inputs of the model
+
+    Args:
+        None
+
+    Returns:
+        the source inputs and the follow-up inputs of the model
+    '''
+
+    def modelInputs(self):
+        return model_input(self.myStartTestSet, self.dataType), model_input(self.myTestSet, self.dataType)
+
+
+'''
+Summary: a helper function, return the indexes of the cases whose source and follow-up predictions are not equal
+'''
+
+
+def violating_indexes(model, sourceInput, followUpInput):
+    predict1 = model.predict_classes(sourceInput)
+    predict2 = model.predict_classes(followUpInput)
+    return [index for index in range(len(predict1)) if predict1[index] != predict2[index]]
+
+
+'''
+Summary: a helper function, call a chain of (name, args, kwargs) MRIPs on a dataset and return the follow-up dataset
+'''
+
+
+def apply_chain(myTestSet, dataType, chain):
+    mt = Mtkeras(myTestSet, dataType)
+    for name, args, kwargs in chain:
+        mt = getattr(mt, name)(*args, **kwargs)
+        if(mt is None):
+            raise ValueError("{} is not supported for the dataType {}.".format(name, dataType))
+    return mt.myTestSet
+
+
+'''
+Summary: a helper function, call the function and return its result and the peak of the memory it allocated, in bytes
+    If tracemalloc is already tracing, it is left running but its peak is reset with tracemalloc.reset_peak(), so a peak the caller measured before is lost.
+'''
+
+
+def traced_peak(function, *args):
+    started = not tracemalloc.is_tracing()
+    if(started):
+        tracemalloc.start()
+    else:
+        tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    try:
+        result = function(*args)
+        peak = tracemalloc.get_traced_memory()[1] - base
+    finally:
+        if(started):
+            tracemalloc.stop()
+    return result, peak
+
+
+'''
+Summary: a helper function, estimate the bytes needed per test case to generate the follow-up test cases with the chain of MRIPs and to preprocess the source and follow-up test cases, by running them on a few test cases
+'''
+
+
+def estimate_bytes_per_sample(probe, dataType, chain):
+    def run():
+        source = np.array(probe)
+        followUp = apply_chain(source.copy(), dataType, chain)
+        return model_input(source, dataType), model_input(followUp, dataType)
+    if(len(probe) == 0):
+        return 0
+    _, peak = traced_peak(run)
+    return peak / len(probe)
+
+
+'''
+Summary: a helper function, preprocess a dataset of the dataType into the inputs of the model
+'''
+
+
+def model_input(data, dataType):
+    if(dataType == 'grayscaleImage'):
+        return data.reshape(data.shape[0], data.shape[1] * data.shape[2])/255
+    elif(dataType == 'colorImage'):
+        return np.array([process_img(ele) for ele in data])
+
+
+'''
+Summary: a helper function, the classes predicted from the output probabilities of the model, the same as predict_classes of Keras
+'''
+
+
+def predicted_classes(probabilities):
+    if(probabilities.shape[1] == 1):
+        return (probabilities[:, 0] > 0.5).astype('int32')
+    return np.argmax(probabilities, axis=1)
+
+
+'''
+Summary: a helper function, the confidence of the model in each prediction, the lower the less confident
+    - margin: the difference between the two highest probabilities
+    - entropy: the negative entropy of the probabilities
+'''
+
+
+def confidence(probabilities, by='margin'):
+    if(by == 'margin'):
+        top = np.sort(probabilities, axis=1)
+        if(top.shape[1] == 1):
+            # a single sigmoid output
+            return np.abs(2 * top[:, 0] - 1)
+        return top[:, -1] - top[:, -2]
+    elif(by == 'entropy'):
+        if(probabilities.shape[1] == 1):
+            # a single sigmoid output, the other class has the probability 1 - p
+            probabilities = np.concatenate([1 - probabilities, probabilities], axis=1)
+        p = np.clip(probabilities, 1e-12, 1)
+        return np.sum(p * np.log(p), axis=1)
+    raise ValueError("unknown priority {}.".format(by))
+
+
+'''
+Summary: a helper function, build the nearest neighbor index of the word embeddings, it only has to be built once for an embedding matrix
+    The cosine similarities are computed block by block, so the memory used is bounded by blockSize * vocabulary size.
+
+Args:
+    - embeddings: ndarray, the embedding matrix, one row per word index
+    - path(optional): string, the path of the .npy file the index is saved to. If given, the returned index is memory-mapped from this file
+    - k(optional): integer, the number of neighbors of each word, it has to be smaller than the number of the words that are not reserved. Default value is 5
+    - reserved(optional): integer, the word indexes smaller than it (padding, start, unknown...) are never chosen as neighbors. Default value is 4
+    - blockSize(optional): integer, the number of words processed at a time. Default value is 1024
+
+Returns:
+    an int32 ndarray of shape (vocabulary size, k), the row i contains the indexes of the k nearest neighbors of the word i, the nearest first
+'''
+
+
+def build_neighbor_index(embeddings, path=None, k=5, reserved=4, blockSize=1024):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    normed = embeddings / np.maximum(norms, 1e-12)
+    n = len(normed)
+    if(k < 1 or k >= n - reserved):
+        raise ValueError("k is {} but it must be between 1 and {}, each word has {} other words which are not reserved.".format(
+            k, n - reserved - 1, n - reserved - 1))
+    if(path is None):
+        index = np.empty((n, k), dtype=np.int32)
+    else:
+        index = np.lib.format.open_memmap(path, mode='w+', dtype=np.int32, shape=(n, k))
+    for start in range(0, n, blockSize):
+        stop = min(start + blockSize, n)
+        similarity = normed[start:stop] @ normed.T
+        # a word is not its own synonym
+        similarity[np.arange(stop - start), np.arange(start, stop)] = -np.inf
+        # padding, start, unknown... are not synonyms either
+        similarity[:, :reserved] = -np.inf
+        nearest = np.argpartition(-similarity, k, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(similarity, nearest, axis=1), axis=1)
+        index[start:stop] = np.take_along_axis(nearest, order, axis=1)
+    if(path is None):
+        return index
+    index.flush()
+    del index
+    return np.load(path, mmap_mode='r')
+
+
+'''
+Summary: a helper function, replace random words of the texts by one of their neighbors, all the words of all the texts are processed in one batch
+'''
+
+
+def substitute_synonyms(texts, neighbors, rate=0.1, reserved=4):
+    if(isinstance(neighbors, str)):
+        neighbors = np.load(neighbors, mmap_mode='r')
+    # padded sequences, e.g. the output of pad_sequences
+    if(isinstance(texts, np.ndarray) and texts.dtype != object):
+        words = texts.copy()
+        mask = ((np.random.random(words.shape) < rate) &
+                (words >= reserved) & (words < len(neighbors)))
+        column = np.random.randint(0, neighbors.shape[1], int(mask.sum()))
+        words[mask] = neighbors[words[mask], column]
+        return words
+    if(len(texts) == 0):
+        return texts[:0]
+
+    lengths = np.fromiter((len(ele) for ele in texts), dtype=np.int64, count=len(texts))
+    words = np.fromiter(itertools.chain.from_iterable(texts),
+                        dtype=np.int64, count=int(lengths.sum()))
+    mask = ((np.random.random(len(words)) < rate) &
+            (words >= reserved) & (words < len(neighbors)))
+    column = np.random.randint(0, neighbors.shape[1], int(mask.sum()))
+    words[mask] = neighbors[words[mask], column]
+
+    if(isinstance(texts, np.ndarray)):
+        output = np.empty(len(texts), dtype=object)
+    else:
+        output = [None] * len(texts)
+    for i, ele in enumerate(np.split(words, np.cumsum(lengths)[:-1])):
+        output[i] = ele.tolist()
+    return output
+
 
 '''
 Summary: a helper function, for image preprocessing before prediction
@@ -434,6 +876,44 @@ class Mtkeras_mrip:
         self.myTestSet = myTestSet
         self.myStartTestSet = myTestSet
         self.dataType = dataType
+
+    '''
+    Summary:
+        For 8-bit images (uint8 ndarray), the intensity MRIPs (additive, multiplicative, brightness and invertive) are pointwise functions of 256 input values.
+        Instead of making a full pass over the dataset, each step is applied to a 256-entry lookup table, which starts as the values 0 to 255 in uint8 and goes through exactly the same arithmetic (and dtype changes) as the dataset would. The table is applied to the dataset with a single np.take over the uint8 data the next time ".myTestSet" is read, so the result is identical to running the steps one by one.
+
+    Args:
+        - step: a function which applies the MRIP to the lookup table and returns the new table, or None if the step can not be fused
+        - dataTypes(optional): the dataTypes the MRIP supports. Default value is ('grayscaleImage', 'colorImage')
+
+    Returns:
+        True if the step has been folded into the pending table, False if the dataset is not an 8-bit image set of a supported dataType or the step can not be fused
+    '''
+
+    def fuseLut(self, step, dataTypes=('grayscaleImage', 'colorImage')):
+        if(self.dataType not in dataTypes or
+                getattr(self._myTestSet, 'dtype', None) != np.uint8):
+            return False
+        lut = self.pendingLut
+        if(lut is None):
+            lut = np.arange(256, dtype=np.uint8)
+        lut = step(lut)
+        if(lut is None):
+            return False
+        self.pendingLut = lut
+        return True
+
+    @property
+    def myTestSet(self):
+        if(self.pendingLut is not None):
+            self._myTestSet = np.take(self.pendingLut, self._myTestSet)
+            self.pendingLut = None
+        return self._myTestSet
+
+    @myTestSet.setter
+    def myTestSet(self, value):
+        self.pendingLut = None
+        self._myTestSet = value
     '''
     Summary:
         The "permutative" MRIP: the user can shuffle the order of the data randomly in the dataset
@@ -467,6 +947,9 @@ class Mtkeras_mrip:
     '''
 
     def additive(self, n_additive):
+        # 8-bit images: fold the step into the pending lookup table
+        if(self.fuseLut(lambda lut: lut + float(n_additive), ('grayscaleImage',))):
+            return self
         # add a constant to every pixel in a picture
         if(self.dataType == 'grayscaleImage'):
             picx = self.myTestSet.shape[1]
@@ -489,11 +972,15 @@ class Mtkeras_mrip:
     '''
 
     def brightness(self, gamma=1, gain=1):
+        # adjust_gamma refuses negative values, which only the pixels can tell
+        if(self.fuseLut(lambda lut: None if lut.min() < 0 else
+                        skimage.exposure.adjust_gamma(lut, gamma, gain).astype(lut.dtype))):
+            return self
         # adjust the brightness of the picture
         for index, ele in enumerate(self.myTestSet):
             self.myTestSet[index] = skimage.exposure.adjust_gamma(
                 ele, gamma, gain)
-            return self
+        return self
 
     '''
     Summary:
@@ -508,6 +995,8 @@ class Mtkeras_mrip:
     '''
 
     def multiplicative(self, n_mul):
+        if(self.fuseLut(lambda lut: lut * n_mul, ('grayscaleImage',))):
+            return self
         # multiple every pixel by a constant
         if(self.dataType == 'grayscaleImage'):
             self.myTestSet = self.myTestSet * n_mul
@@ -526,11 +1015,17 @@ class Mtkeras_mrip:
     '''
 
     def invertive(self):
+        if(self.fuseLut(lambda lut: 255 - lut)):
+            return self
         # invert the order of the text sequence
         if(self.dataType == 'text'):
             for i in range(len(self.myTestSet)):
                 self.myTestSet[i].reverse()
             return self
+        # invert the intensity of every pixel in a picture
+        elif(self.dataType in ('grayscaleImage', 'colorImage')):
+            self.myTestSet = 255 - self.myTestSet
+            return self
 
     '''
     Summary:
@@ -574,6 +1069,29 @@ class Mtkeras_mrip:
                     0, self.myTestSet.shape[0])].insert(0, 4)
             return self
 
+    '''
+    Summary:
+        the "synonym" MRIP: replace some of the words in a text by one of their nearest neighbors in an embedding space, which is a more realistic noise than inserting a word.
+        The neighbors are looked up in a precomputed index (see build_neighbor_index), and the substitutions are done in one batch over all the words of the dataset.
+        Padded sequences (a 2D int ndarray, e.g. the output of pad_sequences) are processed fully in numpy and are the path that generates the follow-ups of 10^6 texts in seconds. Lists of word lists have to be flattened and rebuilt in Python, which takes about 45 s for 10^6 texts of 230 words.
+
+    Args:
+        - neighbors: ndarray or string, the nearest neighbor index returned by build_neighbor_index, or the path of the .npy file it has been saved to (it is memory-mapped)
+        - rate(optional): float, the probability for each word to be replaced. Default value is 0.1
+        - reserved(optional): integer, the word indexes smaller than it (padding, start, unknown...) are never replaced. Default value is 4
+
+    Returns:
+        - a Mtkeras Object
+        - call the property ".myTestSet" to return a tranformed dataset(an array/ndarray)
+    '''
+
+    def synonym(self, neighbors, rate=0.1, reserved=4):
+        # replace random words by their neighbors in the embedding space
+        if(self.dataType == 'text'):
+            self.myTestSet = substitute_synonyms(
+                self.myTestSet, neighbors, rate, reserved)
+            return self
+
     '''
     Summary:
         the "fliph" MRIP: flip the data horizontally
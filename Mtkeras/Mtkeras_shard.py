@@ -0,0 +1,482 @@
+# -*- coding: utf-8 -*-
+"""
+Sharded execution of one metamorphic testing run over several machines.
+
+The coordinator and the workers only share a directory (e.g. an NFS mount),
+no message broker is needed. A shard is claimed by atomically renaming its
+token file, so two workers can never run the same shard at the same time.
+
+"""
+
+import json
+import os
+import pickle
+import random
+import socket
+import time
+import threading
+import traceback
+import multiprocessing
+
+import numpy as np
+
+from .Mtkeras import Mtkeras
+
+
+class Mtkeras_shard:
+
+    """
+    Summary:
+        The coordinator of a sharded MR run. It splits the source test set into deterministic shards, each one with its own seed, and publishes them in a work queue on a shared filesystem.
+        Workers (see Mtkeras_worker) pick up the shards, run the MR chain on them and write back the indexes of the violating cases. The coordinator requeues the shards of dead workers, and merges the shard results into one globally indexed violation set.
+
+    Implementation:
+        coordinator = Mtkeras_shard(<queueDir>, <sourceTestSet>, <dataType>, [(<MRIP>, <args>, <kwargs>), ..., (<MROP>, <args>, <kwargs>)])
+        coordinator.submit()
+        then start "Mtkeras_worker(<queueDir>, <model>).run()" on every node, or coordinator.runLocal(<n_workers>, <modelLoader>) on one machine
+        coordinator.wait().merge()
+
+    Args:
+        - queueDir: string, the path of the shared directory used as the work queue
+        - myTestSet: an array or ndarray that contains the source test cases, it can be omitted when the coordinator only attaches to a queue that has already been submitted
+        - dataType: a string, the same as the "dataType" of Mtkeras
+        - chain: a list of (name, args, kwargs) tuples, the MRIPs and the final MROP to be called on Mtkeras, e.g. [('fliph', (), {}), ('equality', (), {})]
+        - n_shards(optional): integer, the number of shards. Default value is 8
+        - seed(optional): integer, the seed every shard seed is derived from. Default value is 0
+        - maxRetries(optional): integer, the total number of times a shard is tried, the first attempt included, before it is given up. Default value is 3
+        - leaseTimeout(optional): float, the number of seconds after which a claimed shard with no result is considered lost and requeued. Default value is 3600
+
+    Returns:
+        - call the property ".violatingCases" after merge() to return the global indexes of the violating cases
+        - call the property ".failedShards" after merge() to return the shards that were given up
+    """
+
+    def __init__(self, queueDir, myTestSet=None, dataType='grayscaleImage', chain=None, n_shards=8, seed=0, maxRetries=3, leaseTimeout=3600):
+        self.queueDir = queueDir
+        self.myTestSet = myTestSet
+        self.dataType = dataType
+        self.chain = chain or []
+        self.n_shards = n_shards
+        self.seed = seed
+        self.maxRetries = maxRetries
+        self.leaseTimeout = leaseTimeout
+        self.violatingCases = []
+        self.failedShards = []
+
+    '''
+    Summary:
+        write the manifest, the shards and one token per shard into the queue directory, which has to be empty or not exist yet
+
+    Args:
+        None
+
+    Returns:
+        - a Mtkeras_shard Object
+    '''
+
+    def submit(self):
+        if(os.path.isdir(self.queueDir) and os.listdir(self.queueDir)):
+            raise ValueError(
+                "The queue directory {} is not empty, use a new directory for every run.".format(self.queueDir))
+        bounds = shard_bounds(len(self.myTestSet), self.n_shards)
+        shards = []
+        for shard, (start, stop) in enumerate(bounds):
+            shards.append({'shard': shard, 'name': shard_name(shard), 'start': start,
+                           'stop': stop, 'seed': shard_seed(self.seed, shard)})
+        manifest = {
+            'dataType': self.dataType,
+            'chain': [[name, list(args), kwargs] for name, args, kwargs in self.chain],
+            'maxRetries': self.maxRetries,
+            'leaseTimeout': self.leaseTimeout,
+            'shards': shards,
+        }
+        # fail on a chain which can not be stored in json before the queue is populated
+        json.dumps(manifest)
+
+        for sub in ('shards', 'todo', 'claimed', 'results', 'failed'):
+            os.makedirs(os.path.join(self.queueDir, sub), exist_ok=True)
+        for ele in shards:
+            save_shard(os.path.join(self.queueDir, 'shards', ele['name']),
+                       self.myTestSet[ele['start']:ele['stop']])
+        write_json(os.path.join(self.queueDir, 'manifest.json'), manifest)
+        for ele in shards:
+            write_json(os.path.join(self.queueDir, 'todo', ele['name']),
+                       {'shard': ele['shard'], 'attempt': 0})
+        return self
+
+    '''
+    Summary:
+        move the shards whose claim is older than "leaseTimeout" back to the queue, the worker which claimed them is assumed to be dead
+
+    Args:
+        None
+
+    Returns:
+        the number of the requeued shards
+    '''
+
+    def requeueStale(self):
+        return requeue_stale(self.queueDir, self.leaseTimeout, self.maxRetries)
+
+    '''
+    Summary:
+        block until every shard has either a result or has been given up, requeueing the stale shards on the way
+
+    Args:
+        - timeout(optional): float, the maximum number of seconds to wait, None means wait forever
+        - poll(optional): float, the number of seconds between two scans of the queue. Default value is 1
+
+    Returns:
+        - a Mtkeras_shard Object
+    '''
+
+    def wait(self, timeout=None, poll=1):
+        total = len(read_json(os.path.join(self.queueDir, 'manifest.json'))['shards'])
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            done = finished_count(self.queueDir)
+            if(done >= total):
+                return self
+            if(deadline is not None and time.time() > deadline):
+                raise TimeoutError(
+                    "{} of {} shards are finished.".format(done, total))
+            self.requeueStale()
+            time.sleep(poll)
+
+    '''
+    Summary:
+        start several worker processes on this machine and wait for them, mainly used for testing the queue on a single node
+
+    Args:
+        - n_workers: integer, the number of the worker processes
+        - modelLoader(optional): a function without argument which returns the model under test, it is called once in every worker process
+
+    Returns:
+        - a Mtkeras_shard Object
+    '''
+
+    def runLocal(self, n_workers, modelLoader=None):
+        workers = []
+        for i in range(n_workers):
+            worker = multiprocessing.Process(
+                target=run_worker, args=(self.queueDir, modelLoader))
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+        return self
+
+    '''
+    Summary:
+        merge the results of all the shards into one violation set, the indexes of the violating cases refer to the whole source test set
+
+    Args:
+        None
+
+    Returns:
+        - a Mtkeras_shard Object
+        - call the property ".violatingCases" to return the indexes of the violating cases
+
+    Outputs:
+        the number of the violation cases will be printed
+    '''
+
+    def merge(self):
+        manifest = read_json(os.path.join(self.queueDir, 'manifest.json'))
+        self.violatingCases = []
+        self.failedShards = []
+        for ele in manifest['shards']:
+            resultPath = os.path.join(self.queueDir, 'results', ele['name'])
+            if(not os.path.exists(resultPath)):
+                self.failedShards.append(ele['shard'])
+                continue
+            result = read_json(resultPath)
+            size = ele['stop'] - ele['start']
+            if(result.get('shard') != ele['shard'] or result.get('start') != ele['start'] or
+                    result.get('stop') != ele['stop'] or
+                    any(index < 0 or index >= size for index in result['violatingCases'])):
+                raise ValueError(
+                    "The result of {} does not match the manifest.".format(ele['name']))
+            self.violatingCases += [ele['start'] + index
+                                    for index in result['violatingCases']]
+        self.violatingCases.sort()
+        print("There are {num} violations in {n} shards, {failed} shards failed.".format(
+            num=len(self.violatingCases), n=len(manifest['shards']), failed=len(self.failedShards)))
+        return self
+
+
+class Mtkeras_worker:
+
+    """
+    Summary:
+        The worker of a sharded MR run. It claims the shards published by Mtkeras_shard one by one, runs the MR chain of the manifest on them with the shard seed, and writes the indexes of the violating cases back into the queue.
+        A failing shard is put back into the queue until it has been tried "maxRetries" times. While a shard runs, the worker keeps refreshing its claim, so that only the shards of dead workers are requeued.
+        The worker keeps polling the queue until every shard has a result or has been given up, and requeues the stale shards itself, so the shards of dead workers are picked up by the workers still alive.
+
+    Implementation:
+        use one line of code: Mtkeras_worker(<queueDir>, <model>).run()
+
+    Args:
+        - queueDir: string, the path of the shared directory used as the work queue
+        - model(optional): an object, the model under test, loaded on this node
+        - workerId(optional): string, the name of the worker used in the claim files. Default value is "<hostname>-<pid>"
+
+    Returns:
+        - call the property ".doneShards" to return the shards finished by this worker
+    """
+
+    def __init__(self, queueDir, model=None, workerId=None):
+        self.queueDir = queueDir
+        self.model = model
+        self.workerId = workerId or "{}-{}".format(socket.gethostname(), os.getpid())
+        self.doneShards = []
+
+    '''
+    Summary:
+        claim and run shards until every shard of the manifest has a result or has been given up
+
+    Args:
+        - maxShards(optional): integer, the maximum number of shards this worker runs, None means no limit
+        - poll(optional): float, the number of seconds to wait when no shard is left in the queue. Default value is 1
+
+    Returns:
+        - a Mtkeras_worker Object
+    '''
+
+    def run(self, maxShards=None, poll=1):
+        manifest = read_json(os.path.join(self.queueDir, 'manifest.json'))
+        shards = manifest['shards']
+        while maxShards is None or len(self.doneShards) < maxShards:
+            claim = self.claim()
+            if(claim is None):
+                if(finished_count(self.queueDir) >= len(shards)):
+                    break
+                # the other shards are running, take them over if their worker died
+                if(requeue_stale(self.queueDir, manifest['leaseTimeout'], manifest['maxRetries']) == 0):
+                    time.sleep(poll)
+                continue
+            name, path = claim
+            token = read_json(path)
+            ele = shards[token['shard']]
+            stopLease = keep_lease(path, manifest['leaseTimeout'])
+            try:
+                violatingCases = run_shard(
+                    manifest, ele, os.path.join(self.queueDir, 'shards', name), self.model)
+            except Exception:
+                token['attempt'] += 1
+                release_token(self.queueDir, name, token,
+                              traceback.format_exc(), manifest['maxRetries'])
+            else:
+                write_json(os.path.join(self.queueDir, 'results', name),
+                           {'shard': ele['shard'], 'start': ele['start'], 'stop': ele['stop'],
+                            'worker': self.workerId, 'attempt': token['attempt'],
+                            'violatingCases': violatingCases})
+                self.doneShards.append(ele['shard'])
+            finally:
+                stopLease()
+            remove_file(path)
+        return self
+
+    '''
+    Summary:
+        claim one shard of the queue by renaming its token into the "claimed" directory, the rename is atomic so only one worker can win it
+
+    Args:
+        None
+
+    Returns:
+        the name of the shard and the path of the claim file, or None when the queue is empty
+    '''
+
+    def claim(self):
+        todoDir = os.path.join(self.queueDir, 'todo')
+        for name in sorted(list_names(todoDir)):
+            path = os.path.join(self.queueDir, 'claimed',
+                                "{}.{}".format(name, self.workerId))
+            try:
+                os.rename(os.path.join(todoDir, name), path)
+            except OSError:
+                # another worker was faster
+                continue
+            # refresh the mtime, it is the start of the lease
+            os.utime(path, None)
+            return name, path
+        return None
+
+
+'''
+Summary: a helper function, split n cases into n_shards contiguous shards, the same input always gives the same shards
+'''
+
+
+def shard_bounds(n, n_shards):
+    n_shards = max(1, min(n_shards, n))
+    edges = np.linspace(0, n, n_shards + 1).astype(int)
+    return [(int(edges[i]), int(edges[i + 1])) for i in range(n_shards)]
+
+
+'''
+Summary: a helper function, derive the seed of one shard from the seed of the run
+'''
+
+
+def shard_seed(seed, shard):
+    return int(np.random.SeedSequence([seed, shard]).generate_state(1)[0])
+
+
+def shard_name(shard):
+    return "shard_{:05d}".format(shard)
+
+
+'''
+Summary: a helper function, run the MR chain of the manifest on one shard and return the local indexes of the violating cases
+'''
+
+
+def run_shard(manifest, ele, path, model):
+    myTestSet = load_shard(path)
+    random.seed(ele['seed'])
+    np.random.seed(ele['seed'])
+    mt = Mtkeras(myTestSet, manifest['dataType'], model)
+    for name, args, kwargs in manifest['chain']:
+        mt = getattr(mt, name)(*args, **kwargs)
+        if(mt is None):
+            raise ValueError("{} is not supported for the dataType {}.".format(
+                name, manifest['dataType']))
+    return [int(index) for index in mt.violatingCases]
+
+
+'''
+Summary: a helper function, move the claims older than "leaseTimeout" back to the queue and return their number
+    A claim is first renamed to a hidden file, so that when several nodes scan the queue at the same time only one of them requeues it.
+'''
+
+
+def requeue_stale(queueDir, leaseTimeout, maxRetries):
+    claimedDir = os.path.join(queueDir, 'claimed')
+    now = time.time()
+    count = 0
+    for claim in list_names(claimedDir):
+        path = os.path.join(claimedDir, claim)
+        name = claim.split('.')[0]
+        # unique per node, so that a node never touches the file renamed by another one
+        stale = os.path.join(claimedDir, '.{}.{}-{}.stale'.format(
+            claim, socket.gethostname(), os.getpid()))
+        try:
+            if(now - os.path.getmtime(path) < leaseTimeout):
+                continue
+            os.rename(path, stale)
+        except OSError:
+            # the worker has just finished the shard, or another node requeued it
+            continue
+        try:
+            token = read_json(stale)
+        except ValueError:
+            # the claim is corrupted, give the shard up rather than lose it
+            write_json(os.path.join(queueDir, 'failed', name),
+                       {'shard': int(name.split('_')[1]), 'error': 'corrupted claim'})
+            remove_file(stale)
+            continue
+        except OSError:
+            # put the claim back, the next scan tries again
+            os.rename(stale, path)
+            continue
+        token['attempt'] += 1
+        release_token(queueDir, name, token, 'worker lost', maxRetries)
+        remove_file(stale)
+        count += 1
+    return count
+
+
+'''
+Summary: a helper function, refresh the mtime of a claim in the background while its shard runs, so that it is not taken for the claim of a dead worker
+    It returns the function which stops the refreshing.
+'''
+
+
+def keep_lease(path, leaseTimeout):
+    stop = threading.Event()
+
+    def refresh():
+        while not stop.wait(leaseTimeout / 3):
+            try:
+                os.utime(path, None)
+            except OSError:
+                # e.g. a short hiccup of the shared filesystem, retry on the next tick
+                pass
+
+    thread = threading.Thread(target=refresh, daemon=True)
+    thread.start()
+
+    def stopLease():
+        stop.set()
+        thread.join()
+    return stopLease
+
+
+def finished_count(queueDir):
+    return len(list_names(os.path.join(queueDir, 'results')) |
+               list_names(os.path.join(queueDir, 'failed')))
+
+
+'''
+Summary: a helper function, put a token back into the queue, or give the shard up after "maxRetries" attempts
+'''
+
+
+def release_token(queueDir, name, token, error, maxRetries):
+    if(token['attempt'] < maxRetries):
+        write_json(os.path.join(queueDir, 'todo', name), token)
+    else:
+        token['error'] = error
+        write_json(os.path.join(queueDir, 'failed', name), token)
+
+
+def run_worker(queueDir, modelLoader):
+    model = modelLoader() if modelLoader is not None else None
+    Mtkeras_worker(queueDir, model).run()
+
+
+def save_shard(path, data):
+    if(isinstance(data, np.ndarray) and data.dtype != object):
+        np.save(path + '.npy', data)
+    else:
+        with open(path + '.pkl', 'wb') as f:
+            pickle.dump(data, f)
+
+
+def load_shard(path):
+    if(os.path.exists(path + '.npy')):
+        return np.load(path + '.npy')
+    with open(path + '.pkl', 'rb') as f:
+        return pickle.load(f)
+
+
+'''
+Summary: a helper function, write a json file atomically so that a reader never sees half of it
+'''
+
+
+def write_json(path, data):
+    tmp = os.path.join(os.path.dirname(path), ".{}.{}-{}.tmp".format(
+        os.path.basename(path), socket.gethostname(), os.getpid()))
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def list_names(path):
+    # skip the temporary files of write_json
+    return set(name for name in os.listdir(path) if not name.startswith('.'))
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass